@@ -52,16 +52,16 @@ while True:
         reader.read()
 
         # Read any lines that have been sent by the E5 module.  Check to 
-        # see if they are downlinks & process if so.
+        # see if they are downlinks & process if so.  Lines are checked as
+        # bytes so no strings are created for each line.
         while True:
             lin = e5_uart.readline()
             if lin is None: break
-            try:
-                lin_str = str(lin, 'ascii').strip()
-                print(lin_str)
-                lora.check_for_downlink(lin_str, e5_uart)
-            except:
-                print('Bad character in line:', lin)
+            print(lin)
+            lora.check_for_downlink(lin, e5_uart)
+
+        # Acknowledge any multi-setting downlink, once the E5 is idle.
+        lora.send_pending_ack(e5_uart)
 
     except KeyboardInterrupt:
         sys.exit()
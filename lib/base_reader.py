@@ -2,6 +2,7 @@
 each time through the main script loop.  Also contains infrastructure
 for sending reading values to the LoRa-E5 module via a UART.
 """
+import lora
 
 class BaseReader:
     """Reader classes should inherit from this class, which provides access to the
@@ -17,10 +18,7 @@ class BaseReader:
     def send_data(self, msg):
         """Sends the HEX string 'msg' to the E5 module with a AT+MSGHEX command.
         """
-        final_msg = 'AT+MSGHEX="' + msg + '"\n'
-
-        cmd = bytes(final_msg, 'utf-8')
-        self.uart.write(cmd)
+        lora.send_msg(msg, self.uart)
 
     def read(self):
         raise NotImplementedError('The read method needs to be implmented.')
\ No newline at end of file
@@ -7,6 +7,33 @@ from microcontroller import nvm        # non-volatile memory
 # Starting indexes for values stored in non-volatile memory.
 ADDR_DETAIL = 0    # Holds Detail boolean
 ADDR_SECS_BETWEEN_XMIT = 1     # Index of 2-byte integer of # of seconds between transmission
+ADDR_PCT_CHG_THRESH = 3        # 2-byte integer, percent change threshold in units of 0.1%
+ADDR_ABS_CHG_THRESH = 5        # 2-byte integer, absolute change threshold in units of 0.1 W
+ADDR_MAX_READING_GAP_SECS = 7  # 2-byte integer, seconds
+ADDR_SAMPLES = 9               # 2-byte integer, samples per power measurement
+NVM_SIZE = 11                  # total number of bytes of NVM used by the configuration
+
+# A 2-byte NVM value that has never been written
+NVM_UNSET = 2**16 - 1
+
+def _read_u16(addr):
+    """Returns the 2-byte integer stored at 'addr' in non-volatile memory, or
+    None if those bytes have never been written."""
+    val = nvm[addr] * 256 + nvm[addr + 1]
+    return None if val == NVM_UNSET else val
+
+def crc16(data):
+    """Returns the CRC-16/CCITT-FALSE checksum of the bytes in 'data'.
+    """
+    crc = 0xFFFF
+    for b in data:
+        crc ^= b << 8
+        for _ in range(8):
+            if crc & 0x8000:
+                crc = ((crc << 1) ^ 0x1021) & 0xFFFF
+            else:
+                crc = (crc << 1) & 0xFFFF
+    return crc
 
 class Configuration:
 
@@ -18,9 +45,24 @@ class Configuration:
     # average_power_reader.py module.
     DETAIL_DEFAULT = False
 
+    # Samples to take for each power measurement. Will run out of memory if too many. 
+    # It takes about 104 to cover one 60 Hz cycle.  Played with this to minimize unused
+    # samples.  A downlink can lower the number of samples but not raise it above
+    # this default, as memory is the limit.
+    SAMPLES_DEFAULT = int(105 * 7)
+    SAMPLES_MIN = 105             # need at least one full AC cycle
+
     # Number of seconds per main loop (affected by speed of micro-controller and number 
-    # of SAMPLES).  Run the src_test/time_loop.py program to determine this value.
+    # of SAMPLES).  Run the tools/time_loop.py program to determine this value.
     SECS_PER_LOOP = 0.901      # 105 * 7 SAMPLES, M0 QT Py
+
+    # Approximate seconds from sending a message until the E5 reports it is Done: the
+    # 2 second LoRaWAN RX2 receive delay plus up to a second of airtime.  The E5 will
+    # not accept another message in this time.
+    E5_SEND_SECS = 3.0
+
+    # Shortest time allowed between transmissions: one main loop plus the E5 send time.
+    MIN_SECS_BETWEEN_XMIT = SECS_PER_LOOP + E5_SEND_SECS
     
     # --- Settings related to the Detail Power Reader
     # Constants that control when power readings are sent via LoRaWAN:
@@ -28,9 +70,13 @@ class Configuration:
                               #    fraction, i.e. 0.03 is 3%
     ABS_CHG_THRESH = 7.0      # Power must change by at least this many Watts
 
-    # If haven't sent in this number of measurements, force a send.
+    # If haven't sent in this number of seconds, force a send.
     MAX_READING_GAP_SECS = 900
-    MAX_READING_GAP = int(MAX_READING_GAP_SECS / SECS_PER_LOOP)
+
+    # LoRaWAN radio can't accept readings too close in time. Min gap
+    # expressed in seconds; converted to measurements using the loop time, which
+    # depends on the number of samples.  MAX_READING_GAP_SECS can't be set lower.
+    MIN_READING_GAP_SECS = 6.3
 
     # --- Settings related to Average Power Reader
     # If not changed by a downlink, this is the default number seconds between
@@ -52,40 +98,125 @@ class Configuration:
             self._detail = Configuration.DETAIL_DEFAULT
 
         # Seconds between Transmissions for Averaging mode
-        nvm_val = nvm[ADDR_SECS_BETWEEN_XMIT] * 256 + nvm[ADDR_SECS_BETWEEN_XMIT + 1]
-        if nvm_val != (2**16 - 1):
+        nvm_val = _read_u16(ADDR_SECS_BETWEEN_XMIT)
+        if nvm_val is not None:
             self._secs_between_xmit = nvm_val
         else:
             self._secs_between_xmit = Configuration.SECS_BETWEEN_XMIT_DEFAULT
 
+        # Settings that can only be changed with a multi-setting downlink. These
+        # are held in the units used for NVM storage (see the ADDR_ constants).
+        nvm_val = _read_u16(ADDR_PCT_CHG_THRESH)
+        self._pct_chg_thresh = nvm_val if nvm_val is not None else int(Configuration.PCT_CHG_THRESH * 1000 + 0.5)
+        nvm_val = _read_u16(ADDR_ABS_CHG_THRESH)
+        self._abs_chg_thresh = nvm_val if nvm_val is not None else int(Configuration.ABS_CHG_THRESH * 10 + 0.5)
+        nvm_val = _read_u16(ADDR_MAX_READING_GAP_SECS)
+        self._max_reading_gap_secs = nvm_val if nvm_val is not None else Configuration.MAX_READING_GAP_SECS
+        nvm_val = _read_u16(ADDR_SAMPLES)
+        self._samples = nvm_val if nvm_val is not None else Configuration.SAMPLES_DEFAULT
+
+    # Settings are changed only through the update() method, so that all changes
+    # share the same validation.
+
     @property
     def detail(self):
         """If True use Detailed reader, otherwise use Averaging Reader.
         """
         return self._detail
 
-    @detail.setter
-    def detail(self, val):
-        if val in (0, 1):
-            self._detail = val
-            nvm[ADDR_DETAIL] = val
-
     @property
     def secs_between_xmit(self):
         """With the Averaging Reader, seconds between transmission
         of average values."""
         return self._secs_between_xmit
 
-    @secs_between_xmit.setter
-    def secs_between_xmit(self, val):
-        if val < (2**16 - 1):
-            self._secs_between_xmit = val
-            nvm[ADDR_SECS_BETWEEN_XMIT] = (val >> 8)
-            nvm[ADDR_SECS_BETWEEN_XMIT + 1] = (val & 0xFF)
+    @property
+    def pct_chg_thresh(self):
+        """Detail Reader percent change threshold, expressed as a fraction."""
+        return self._pct_chg_thresh / 1000.0
+
+    @property
+    def abs_chg_thresh(self):
+        """Detail Reader absolute change threshold, Watts."""
+        return self._abs_chg_thresh / 10.0
+
+    @property
+    def max_reading_gap_secs(self):
+        return self._max_reading_gap_secs
+
+    @property
+    def max_reading_gap(self):
+        """Detail Reader forces a send if nothing has been sent in this number
+        of measurements."""
+        return int(self._max_reading_gap_secs / self.secs_per_loop)
+
+    @property
+    def samples(self):
+        """Number of voltage and current samples in each power measurement."""
+        return self._samples
+
+    @property
+    def secs_per_loop(self):
+        """Seconds per main loop.  SECS_PER_LOOP is scaled in proportion to the
+        number of samples.  This is an approximation: part of the loop time (garbage
+        collection, reference voltage reads, printing) does not depend on the number of
+        samples, so the loop time is underestimated when samples are reduced."""
+        return Configuration.SECS_PER_LOOP * self._samples / Configuration.SAMPLES_DEFAULT
 
     @property
     def reads_between_xmit(self):
-        return int(self.secs_between_xmit / Configuration.SECS_PER_LOOP)
+        return int(self.secs_between_xmit / self.secs_per_loop)
+
+    def nvm_image(self):
+        """Returns a bytearray holding all of the settings in the layout used
+        in non-volatile memory.
+        """
+        image = bytearray(NVM_SIZE)
+        image[ADDR_DETAIL] = 1 if self._detail else 0
+        for addr, val in (
+            (ADDR_SECS_BETWEEN_XMIT, self._secs_between_xmit),
+            (ADDR_PCT_CHG_THRESH, self._pct_chg_thresh),
+            (ADDR_ABS_CHG_THRESH, self._abs_chg_thresh),
+            (ADDR_MAX_READING_GAP_SECS, self._max_reading_gap_secs),
+            (ADDR_SAMPLES, self._samples),
+        ):
+            image[addr] = val >> 8
+            image[addr + 1] = val & 0xFF
+        return image
+
+    def config_hash(self):
+        """Returns a 2-byte hash of the current settings, used by the server to
+        confirm which configuration the device is running."""
+        return crc16(self.nvm_image())
+
+    def update(self, changes):
+        """Applies all of the settings in the 'changes' dictionary, or none of them
+        if any is invalid.  Keys are the setting attribute names without the leading
+        underscore; values are in NVM storage units.  All settings are written to 
+        non-volatile memory in one operation.  Returns True if the changes were applied.
+        """
+        for name, val in changes.items():
+            if name == 'detail':
+                ok = val in (0, 1)
+            elif name == 'samples':
+                ok = Configuration.SAMPLES_MIN <= val <= Configuration.SAMPLES_DEFAULT
+            elif name == 'secs_between_xmit':
+                ok = Configuration.MIN_SECS_BETWEEN_XMIT <= val < NVM_UNSET
+            elif name == 'max_reading_gap_secs':
+                ok = Configuration.MIN_READING_GAP_SECS <= val < NVM_UNSET
+            elif name in ('pct_chg_thresh', 'abs_chg_thresh'):
+                ok = 0 <= val < NVM_UNSET
+            else:
+                ok = False
+            if not ok:
+                return False
+
+        for name, val in changes.items():
+            if name == 'detail':
+                val = bool(val)
+            setattr(self, '_' + name, val)
+        nvm[0:NVM_SIZE] = self.nvm_image()
+        return True
 
 # Instantiate a Config object that will be imported by modules that need access
 # to the configuration information.  So, those modules will execute:
@@ -6,10 +6,6 @@ from base_reader import BaseReader
 import power_measure
 from config import config
 
-# LoRaWAN radio can't accept readings too close in time. Min gap
-# expressed in number of measurements.
-MIN_READING_GAP = 7                        
-
 # States controlling the change detection and data sending process
 ST_FIRST = 0       # First reading after reboot
 ST_NORMAL = 1      # Normal, no change occurred, no max gap
@@ -27,7 +23,7 @@ class DetailReader(BaseReader):
         self.pwr_last_sent_value = None
 
         # counter that tracks how many measurements since last power value was sent
-        self.ix = config.MAX_READING_GAP      # ensures that a reading will be sent immediately
+        self.ix = config.max_reading_gap      # ensures that a reading will be sent immediately
 
         self.state = ST_FIRST
         self.readings = []
@@ -55,9 +51,9 @@ class DetailReader(BaseReader):
         
         # Check absolute change and percent change to see if enough change has occurred
         # to send a reading.
-        result = abs(current_read - last_val) >= config.ABS_CHG_THRESH
+        result = abs(current_read - last_val) >= config.abs_chg_thresh
         if last_val != 0.0:
-            result = result and abs((current_read - last_val) / last_val) >= config.PCT_CHG_THRESH
+            result = result and abs((current_read - last_val) / last_val) >= config.pct_chg_thresh
 
         return result
 
@@ -71,7 +67,7 @@ class DetailReader(BaseReader):
         self.readings.append(pwr)
 
         do_send = False
-        if self.state == ST_NORMAL and self.ix >= config.MAX_READING_GAP:
+        if self.state == ST_NORMAL and self.ix >= config.max_reading_gap:
             self.readings = self.readings[-1:]   # only send current reading
             do_send = True
         
@@ -80,7 +76,7 @@ class DetailReader(BaseReader):
             self.state  = ST_NORMAL
 
         elif self.state == ST_NORMAL:
-            if self.ix < MIN_READING_GAP:
+            if self.ix < config.MIN_READING_GAP_SECS / config.secs_per_loop:
                 # only keep current reading
                 self.readings = self.readings[-1:]
             elif self.is_change(pwr):
@@ -1,35 +1,194 @@
 # Functions releated to LoRa communication
 
+import time
+
 from config import config
 
+# Marker that precedes the Hex payload of a Port 1 Downlink line from the E5, e.g.
+#    +MSGHEX: PORT: 1; RX: "0103"
+DOWNLINK_MARKER = b'PORT: 1; RX: "'
+DOWNLINK_MARKER_LEN = len(DOWNLINK_MARKER)
+
+# Buffer that holds the decoded bytes of a Downlink.  Allocated once so that no
+# memory is allocated when lines from the E5 are checked.
+MAX_DOWNLINK_BYTES = 64
+_rx_buf = bytearray(MAX_DOWNLINK_BYTES)
+
+# Tags used in the multi-setting (request type 04) Downlink.  Each setting is
+# encoded as a 1-byte tag, a 1-byte value length and a big-endian value.
+TAG_DATA_RATE = 0x01             # 1 byte, LoRaWAN data rate 0 - 3
+TAG_DETAIL = 0x02                # 1 byte, 1 is Detail mode, 0 is Average mode
+TAG_SECS_BETWEEN_XMIT = 0x03     # 2 bytes, seconds
+TAG_PCT_CHG_THRESH = 0x04        # 2 bytes, units of 0.1%
+TAG_ABS_CHG_THRESH = 0x05        # 2 bytes, units of 0.1 W
+TAG_MAX_READING_GAP_SECS = 0x06  # 2 bytes, seconds
+TAG_SAMPLES = 0x07               # 2 bytes
+
+# Maps tag to (config setting name, value length in bytes).  Data Rate is not a
+# config setting, as it is held by the E5 module.
+TAG_SETTINGS = {
+    TAG_DETAIL: ('detail', 1),
+    TAG_SECS_BETWEEN_XMIT: ('secs_between_xmit', 2),
+    TAG_PCT_CHG_THRESH: ('pct_chg_thresh', 2),
+    TAG_ABS_CHG_THRESH: ('abs_chg_thresh', 2),
+    TAG_MAX_READING_GAP_SECS: ('max_reading_gap_secs', 2),
+    TAG_SAMPLES: ('samples', 2),
+}
+
+# Status codes returned in the configuration acknowledgement Uplink
+ACK_APPLIED = 0
+ACK_REJECTED = 1
+
+# Line the E5 sends when it has finished a send, including the receive windows.
+SEND_DONE = b'+MSGHEX: Done'
+
+# If the Done line is missed, consider the E5 idle after this many seconds.
+SEND_TIMEOUT_SECS = 30.0
+
+# Status of a multi-setting Downlink that still needs to be acknowledged, or None.
+_ack_pending = None
+
+# time.monotonic() value when the last message was sent to the E5, or None if the 
+# E5 has reported that the send is Done.
+_send_start = None
+
+def e5_busy():
+    """True if the E5 is still sending a message or has its receive windows open."""
+    global _send_start
+    if _send_start is not None and time.monotonic() - _send_start > SEND_TIMEOUT_SECS:
+        _send_start = None
+    return _send_start is not None
+
+def send_msg(msg, e5_uart):
+    """Sends the HEX string 'msg' to the E5 module with a AT+MSGHEX command, and
+    marks the E5 as busy until it reports the send is Done."""
+    global _send_start
+    cmd = bytes('AT+MSGHEX="' + msg + '"\n', 'utf-8')
+    e5_uart.write(cmd)
+    _send_start = time.monotonic()
+
 def send_reboot(e5_uart):
     """Send a message indicating that a reboot occurred."""
     print('reboot')     # debug print
-    cmd = bytes('AT+MSGHEX="02"\n', 'utf-8')
+    send_msg('02', e5_uart)
+
+def send_pending_ack(e5_uart):
+    """If a multi-setting Downlink has been processed, send the acknowledgement
+    message, which holds the status code and the hash of the resulting configuration.
+    The acknowledgement stays pending until the E5 is idle, which also means it is
+    not sent on a pass where a reader sent a message."""
+    global _ack_pending
+    if _ack_pending is None or e5_busy():
+        return
+    print('config ack', _ack_pending)     # debug print
+    send_msg('04%02X%04X' % (_ack_pending, config.config_hash()), e5_uart)
+    _ack_pending = None
+
+def _hex_val(c):
+    """Returns the value of the ASCII Hex character code 'c', or -1 if not Hex."""
+    if 48 <= c <= 57:        # 0 - 9
+        return c - 48
+    c |= 0x20                # lower case
+    if 97 <= c <= 102:       # a - f
+        return c - 87
+    return -1
+
+def _decode_downlink(lin):
+    """If the bytes 'lin' are a Downlink line from the E5, decode the Hex payload
+    into the _rx_buf buffer and return the number of bytes decoded.  Return 0 if
+    it is not a Downlink or the payload is not valid Hex."""
+    start = lin.find(DOWNLINK_MARKER)
+    if start < 0:
+        return 0
+    start += DOWNLINK_MARKER_LEN
+    end = lin.find(b'"', start)
+    if end < 0 or (end - start) % 2 or (end - start) // 2 > MAX_DOWNLINK_BYTES:
+        return 0
+    n = 0
+    for i in range(start, end, 2):
+        hi = _hex_val(lin[i])
+        lo = _hex_val(lin[i + 1])
+        if hi < 0 or lo < 0:
+            return 0
+        _rx_buf[n] = (hi << 4) | lo
+        n += 1
+    return n
+
+def _valid_data_rate(dr):
+    return dr in (0, 1, 2, 3)
+
+def _set_data_rate(dr, e5_uart):
+    cmd = bytes('AT+DR=%s\n' % dr, 'utf-8')
     e5_uart.write(cmd)
 
+def _process_settings(n):
+    """Process the multi-setting Downlink held in the first 'n' bytes of _rx_buf.
+    All settings are validated before any are applied, so either all or none of 
+    them take effect.  Returns (status code, data rate to set or None)."""
+    changes = {}
+    dr = None
+    i = 1                        # skip the request type byte
+    while i < n:
+        if i + 2 > n:
+            return ACK_REJECTED, None
+        tag = _rx_buf[i]
+        length = _rx_buf[i + 1]
+        i += 2
+        if i + length > n:
+            return ACK_REJECTED, None
+        val = 0
+        for j in range(i, i + length):
+            val = (val << 8) | _rx_buf[j]
+        i += length
+
+        if tag == TAG_DATA_RATE:
+            if length != 1 or not _valid_data_rate(val):
+                return ACK_REJECTED, None
+            dr = val
+        elif tag in TAG_SETTINGS:
+            name, expected_len = TAG_SETTINGS[tag]
+            if length != expected_len:
+                return ACK_REJECTED, None
+            changes[name] = val
+        else:
+            return ACK_REJECTED, None
+
+    if not config.update(changes):
+        return ACK_REJECTED, None
+    return ACK_APPLIED, dr
+
 def check_for_downlink(lin, e5_uart):
-    """'lin' is a line received from the E5 module.  Check to see if it is
-    a Downlink message, and if so, process the request."""
-    if 'PORT: 1; RX: "' in lin:
-        # this is a Downlink message. Pull out the Hex string data.  First two
-        # characters indicate the request type.
-        data = lin.split('"')[-2]
-        if data[:2] == '01':
-            # Request to change Data Rate. Data rate is given in the 3rd & 4th 
-            # characters.
-            dr = int(data[2:4], 16)
-            if dr in (0, 1, 2, 3):
-                cmd = bytes('AT+DR=%s\n' % dr, 'utf-8')
-                e5_uart.write(cmd)
-
-        elif data[:2] == '02':
-            # Request to change Detail mode: 1 is Detail mode, 0 is Average mode
-            mode = int(data[2:4], 16)
-            config.detail = mode
-
-        elif data[:2] == '03':
-            # Request to change time between transmissions, 2 byte (4 Hex characters)
-            secs = int(data[2:6], 16)
-            print('Setting time between transmits to', secs, 'seconds')
-            config.secs_between_xmit = secs
+    """'lin' is a line (bytes) received from the E5 module.  Check to see if it is
+    a Downlink message, and if so, process the request.  Also tracks when the E5
+    has finished sending."""
+    global _ack_pending, _send_start
+    if lin.startswith(SEND_DONE):
+        _send_start = None
+        return
+    n = _decode_downlink(lin)
+    if n == 0:
+        return
+    # First byte indicates the request type.
+    req = _rx_buf[0]
+    if req == 0x01 and n >= 2:
+        # Request to change Data Rate. Data rate is given in the 2nd byte.
+        dr = _rx_buf[1]
+        if _valid_data_rate(dr):
+            _set_data_rate(dr, e5_uart)
+
+    elif req == 0x02 and n >= 2:
+        # Request to change Detail mode: 1 is Detail mode, 0 is Average mode
+        config.update({'detail': _rx_buf[1]})
+
+    elif req == 0x03 and n >= 3:
+        # Request to change time between transmissions, 2 byte integer
+        secs = _rx_buf[1] * 256 + _rx_buf[2]
+        print('Setting time between transmits to', secs, 'seconds')
+        config.update({'secs_between_xmit': secs})
+
+    elif req == 0x04:
+        # Request to change multiple settings at once, acknowledged with an Uplink.
+        status, dr = _process_settings(n)
+        if dr is not None:
+            _set_data_rate(dr, e5_uart)
+        _ack_pending = status
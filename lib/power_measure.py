@@ -18,10 +18,6 @@ import calibrate
 # sensing.
 CUR_V_WT = 0.97
 
-# Samples to take. Will run out of memory if too many. It takes about 104
-# to cover one 60 Hz cycle.  Played with this to minimize unused samples.
-SAMPLES = int(105 * 7)
-
 # Identify the pins that have the voltage, current and reference voltage.
 v_in = AnalogIn(board.A0)
 i_in = AnalogIn(board.A1)
@@ -34,7 +30,7 @@ vref_in = AnalogIn(board.A2)
 
 def measure_once():
     """Returns average power measured across a number of full AC
-    cycles.  Total cycles measured is related to the SAMPLES constant above.
+    cycles.  Total cycles measured is related to the config.samples setting.
     In order to not exceed resolution of single-precision float variable,
     calculate average power for each cycle, and then average the cycle values.
     """
@@ -47,7 +43,7 @@ def measure_once():
     vref /= n_ref
 
     # collect all the samples.
-    n = SAMPLES
+    n = config.samples
     v_arr = [0] * n
     i_arr = [0] * n
 
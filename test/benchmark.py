@@ -0,0 +1,527 @@
+#!/usr/bin/env python3
+"""Replay-based benchmark of the firmware in the lib directory.
+
+The real power_measure, DetailReader, AverageReader and lora modules are run on
+the PC against simulated hardware: the ADC pins return samples from recorded
+(vi.csv) or synthetic voltage and current waveforms, and the E5 UART records
+uplinks and feeds back the lines the E5 would send, including downlinks.  The
+main loop mirrors code.py.
+
+Each corpus is run with both the Detail and Average readers, and these metrics
+are reported:
+    readings_per_sim_sec  readings per simulated second (see Simulated Time below)
+    ops_per_reading       Python bytecode operations executed per reading
+    alloc_blocks          memory blocks allocated per reading
+    alloc_bytes           bytes allocated per reading
+    err_pct               mean absolute error vs. the reference power, percent
+    err_w                 mean absolute error vs. the reference power, Watts
+    uplinks_per_hour      uplinks sent per simulated hour
+    air_bytes_per_hour    LoRaWAN frame bytes (payload + 13 overhead) per hour
+    dropped_per_hour      uplinks rejected because the E5 was busy, per hour
+
+Ops and allocations are counted only for code in the lib directory, so the
+simulated hardware does not affect them.  Allocations are those still held by
+lib code, taken at the largest point across the returns from lib functions during
+a reading; this catches buffers like the sample arrays, which set the memory
+limit on the M0, but not short-lived objects.
+
+All metrics are deterministic (random numbers are seeded), so they can be
+compared against a baseline file.  They depend on the Python version: the ops
+and allocations directly, and the others because the simulated clock advances with
+the ops.  The version is recorded in the baseline, and comparing against a baseline
+from a different minor version is an error.  Record the baseline with the
+project's Python (pyproject.toml).
+
+Simulated Time: each ADC read advances the clock by the observed M0 sampling
+interval (104 voltage/current sample pairs per 60 Hz cycle).  After each reading,
+the clock advances by the bytecode ops of that reading times SECS_PER_OP, which is
+set so that the default configuration gives the measured config.SECS_PER_LOOP.
+
+The simulated E5 is busy from an AT+MSGHEX command until its Done line has been
+read, and rejects messages sent during that time, as the real module does.
+
+Usage, from the base project directory:
+    python test/benchmark.py            # compare against test/bench_baseline.json
+    python test/benchmark.py --update   # write a new baseline
+Exits with status 1 if any metric regresses by more than the threshold.
+"""
+import argparse
+import contextlib
+import csv
+import gc
+import io
+import json
+import math
+import platform
+import random
+import sys
+import tracemalloc
+import types
+from pathlib import Path
+
+PROJECT_DIR = Path(__file__).resolve().parent.parent
+BASELINE_PATH = Path(__file__).resolve().parent / 'bench_baseline.json'
+RECORDED_PATH = Path(__file__).resolve().parent / 'vi.csv'
+
+# --- Hardware model
+VREF = 40594                # ADC counts of the 2.048 V reference
+V_AMPLITUDE = 18000         # ADC counts, peak of the voltage waveform
+LINE_HZ = 60.0
+SAMPLE_SECS = 1.0 / (LINE_HZ * 104 * 2)    # time per ADC read on the M0
+PHASE = 0.1                 # radians that the load current lags the voltage
+ADC_NOISE = 150             # ADC counts, standard deviation, for noisy corpora
+SECS_PER_OP = 6.08e-6       # M0 seconds per Python bytecode op; see docstring
+
+# E5 timing: seconds from a send until the Downlink line (after the receive 
+# windows) and the Done line are printed.
+E5_RX_SECS = 2.0
+E5_DONE_SECS = 3.0
+
+# LoRaWAN frame overhead in bytes: MHDR, DevAddr, FCtrl, FCnt, FPort, MIC
+LORAWAN_OVERHEAD = 13
+
+# Readings per run that are traced to count ops and allocations.
+PROFILE_READINGS = 3
+
+# Default relative regression threshold, and absolute slack for the accuracy
+# metrics so tiny values don't trip the relative threshold.
+THRESHOLD = 0.05
+METRICS = {
+    # name: (higher is better, absolute slack)
+    'readings_per_sim_sec': (True, 0.0),
+    'ops_per_reading': (False, 0.0),
+    'alloc_blocks': (False, 0.0),
+    'alloc_bytes': (False, 0.0),
+    'err_pct': (False, 0.02),
+    'err_w': (False, 0.1),
+    'uplinks_per_hour': (False, 0.0),
+    'air_bytes_per_hour': (False, 0.0),
+    'dropped_per_hour': (False, 0.0),
+}
+
+LIB_DIR = str(PROJECT_DIR / 'lib')
+
+
+class Simulator:
+    """Produces ADC values and holds the simulated clock."""
+
+    def __init__(self, corpus):
+        self.corpus = corpus
+        self.t = 0.0
+        self.rng = random.Random(corpus.seed)
+        self.noise = ADC_NOISE if corpus.noisy else 0
+
+    def read(self, pin):
+        """Returns the ADC value of 'pin' at the current time and advances the clock."""
+        t = self.t
+        self.t = t + SAMPLE_SECS
+        val = self.corpus.value(pin, t, self.rng)
+        if self.noise:
+            val += self.rng.gauss(0.0, self.noise)
+        return min(max(int(val), 0), 65535)
+
+    def reference(self):
+        """The true power at the current time, Watts."""
+        return self.corpus.reference(self.t)
+
+
+class SineCorpus:
+    """Synthetic voltage and current sine waves, with a load profile giving the
+    real power in Watts as a function of time."""
+
+    def __init__(self, name, profile, calib_mult, seed=1, noisy=False, ct_sign=1,
+                 v_offset=0.0, v_scale=1.0, downlinks=()):
+        self.name = name
+        self.profile = profile
+        self.calib_mult = calib_mult
+        self.seed = seed
+        self.noisy = noisy
+        self.ct_sign = ct_sign
+        self.v_amplitude = V_AMPLITUDE * v_scale
+        self.v_offset = V_AMPLITUDE * v_offset
+        self.downlinks = downlinks
+        self.rewind()
+
+    def rewind(self):
+        """Returns to the start of the corpus."""
+        self._cycle = -1
+        self._i_amplitude = 0.0
+
+    def _current_amplitude(self, t, rng):
+        # only update the load once per AC cycle
+        cycle = int(t * LINE_HZ)
+        if cycle != self._cycle:
+            self._cycle = cycle
+            pwr = self.profile(t)
+            if self.noisy:
+                pwr *= 1.0 + rng.gauss(0.0, 0.05)
+            self._i_amplitude = 2.0 * pwr * VREF ** 2 / (self.calib_mult * self.v_amplitude * math.cos(PHASE))
+        return self._i_amplitude
+
+    def value(self, pin, t, rng):
+        if pin == 'A0':
+            return VREF + self.v_offset + self.v_amplitude * math.sin(2 * math.pi * LINE_HZ * t)
+        elif pin == 'A1':
+            amp = self._current_amplitude(t, rng)
+            return VREF + self.ct_sign * amp * math.sin(2 * math.pi * LINE_HZ * t - PHASE)
+        return VREF
+
+    def reference(self, t):
+        return self.profile(t)
+
+
+class RecordedCorpus:
+    """Plays back the voltage and current samples recorded in vi.csv, looping
+    at the end of the file."""
+
+    name = 'recorded'
+    seed = 1
+    noisy = False
+    downlinks = ()
+
+    def __init__(self, path, calib_mult):
+        with open(path) as f:
+            rows = list(csv.DictReader(f))
+        self.v = [int(r['v']) for r in rows]
+        self.i = [int(r['i']) for r in rows]
+        self.rewind()
+        # the reference is the mean of the product of the signals across the file.
+        self.ref_power = calib_mult * sum(
+            (v - VREF) * (i - VREF) for v, i in zip(self.v, self.i)
+        ) / len(self.v) / VREF ** 2
+
+    def rewind(self):
+        """Returns to the start of the recording."""
+        self.ix = 0
+
+    def value(self, pin, t, rng):
+        if pin == 'A0':
+            self.ix = (self.ix + 1) % len(self.v)
+            return self.v[self.ix]
+        elif pin == 'A1':
+            return self.i[self.ix]
+        return VREF
+
+    def reference(self, t):
+        return self.ref_power
+
+
+class FakeE5:
+    """Stands in for the UART connected to the E5 module.  Records uplinks and
+    queues the lines the E5 sends back, each available once the simulated time
+    reaches it.  Scheduled downlinks are delivered after the first uplink at or after
+    their time, as with a LoRaWAN Class A device.  The E5 is busy from a send until
+    its Done line is read, and rejects sends in that time."""
+
+    def __init__(self, sim, downlinks):
+        self.sim = sim
+        self.downlinks = list(downlinks)
+        self.uplinks = []
+        self.dropped = 0
+        self.busy = False
+        self.lines = []       # (time available, line)
+
+    def write(self, cmd):
+        cmd = bytes(cmd)
+        if not cmd.startswith(b'AT+MSGHEX="'):
+            return
+        t = self.sim.t
+        if self.busy:
+            self.dropped += 1
+            self.lines.append((t, b'+MSGHEX: LoRaWAN modem is busy\r\n'))
+            return
+        self.busy = True
+        payload = cmd.split(b'"')[1]
+        self.uplinks.append(len(payload) // 2)
+        self.lines.append((t, b'+MSGHEX: Start\r\n'))
+        if self.downlinks and self.downlinks[0][0] <= t:
+            _, data = self.downlinks.pop(0)
+            self.lines.append((t + E5_RX_SECS, b'+MSGHEX: PORT: 1; RX: "' + data + b'"\r\n'))
+        self.lines.append((t + E5_DONE_SECS, b'+MSGHEX: Done\r\n'))
+
+    def readline(self):
+        if not self.lines or self.lines[0][0] > self.sim.t:
+            return None
+        _, lin = self.lines.pop(0)
+        if lin.startswith(b'+MSGHEX: Done'):
+            self.busy = False
+        return lin
+
+
+class Firmware:
+    """Loads the firmware modules from the lib directory against simulated hardware."""
+
+    def __init__(self):
+        self.sim = None
+        sim_holder = self
+
+        class AnalogIn:
+            def __init__(self, pin):
+                self.pin = pin
+
+            @property
+            def value(self):
+                return sim_holder.sim.read(self.pin)
+
+        self.nvm = bytearray(b'\xff' * 256)
+        calib = {}
+        exec((PROJECT_DIR / 'calibrate_default.py').read_text(), calib)
+        self.calib_mult = calib['CALIB_MULT']
+
+        self.gc_collects = 0
+
+        def collect():
+            self.gc_collects += 1
+
+        fakes = {
+            'board': types.SimpleNamespace(A0='A0', A1='A1', A2='A2', TX='TX', RX='RX'),
+            'analogio': types.SimpleNamespace(AnalogIn=AnalogIn),
+            'microcontroller': types.SimpleNamespace(nvm=self.nvm),
+            'calibrate': types.SimpleNamespace(CALIB_MULT=self.calib_mult),
+        }
+        sys.modules.update(fakes)
+        sys.path.insert(0, str(PROJECT_DIR / 'lib'))
+
+        import config
+        import power_measure
+        import lora
+        from detail_power_reader import DetailReader
+        from average_power_reader import AverageReader
+        self.config = config
+        self.lora = lora
+        self.DetailReader = DetailReader
+        self.AverageReader = AverageReader
+        # The host heap is not the M0 heap, so garbage collections are counted
+        # rather than run.
+        power_measure.gc = types.SimpleNamespace(collect=collect, mem_free=lambda: 0)
+
+        # Record each power measurement so it can be compared to the reference.
+        self.last_power = None
+        measure = power_measure.measure
+
+        def recording_measure():
+            self.last_power = measure()
+            return self.last_power
+
+        power_measure.measure = recording_measure
+
+        # The firmware's clock is the simulated clock.
+        lora.time = types.SimpleNamespace(monotonic=lambda: self.sim.t)
+
+    def reset(self, corpus, detail):
+        """Returns a fresh (reader, uart) pair with default configuration."""
+        corpus.rewind()
+        self.sim = Simulator(corpus)
+        self.nvm[:] = b'\xff' * len(self.nvm)
+        self.nvm[self.config.ADDR_DETAIL] = 1 if detail else 0
+        self.config.config.__init__()
+        self.lora._ack_pending = None
+        self.lora._send_start = None
+        uart = FakeE5(self.sim, corpus.downlinks)
+        return uart
+
+    def loop_once(self, reader, uart):
+        """One pass through the code.py main loop.  Returns the reader to use
+        for the next pass."""
+        config = self.config.config
+        if config.detail:
+            if type(reader) is not self.DetailReader:
+                reader = self.DetailReader(uart)
+        else:
+            if type(reader) is not self.AverageReader:
+                reader = self.AverageReader(uart)
+        reader.read()
+        while True:
+            lin = uart.readline()
+            if lin is None: break
+            self.lora.check_for_downlink(lin, uart)
+        self.lora.send_pending_ack(uart)
+        return reader
+
+    def profile(self, corpus, detail):
+        """Returns (bytecode ops, allocated blocks, allocated bytes) per reading,
+        counting only code in the lib directory."""
+        uart = self.reset(corpus, detail)
+        lib_filter = [tracemalloc.Filter(True, LIB_DIR + '/*')]
+        ops = 0
+        blocks = 0
+        size = 0
+
+        def lib_tracer(frame, event, arg):
+            nonlocal ops, blocks, size
+            if event == 'opcode':
+                ops += 1
+            elif event == 'return' and tracemalloc.is_tracing():
+                stats = tracemalloc.take_snapshot().filter_traces(lib_filter).statistics('filename')
+                blocks = max(blocks, sum(st.count for st in stats))
+                size = max(size, sum(st.size for st in stats))
+            return lib_tracer
+
+        def tracer(frame, event, arg):
+            # only trace frames of firmware code
+            if not frame.f_code.co_filename.startswith(LIB_DIR):
+                return None
+            frame.f_trace_opcodes = True
+            return lib_tracer
+
+        sys.settrace(tracer)
+        try:
+            # Create the reader and warm up outside of the measurement.  The first
+            # time a function is traced, Python allocates memory for the tracing
+            # that would otherwise be counted against the firmware.
+            reader = None
+            for _ in range(PROFILE_READINGS):
+                reader = self.loop_once(reader, uart)
+            ops = 0
+            # A full collection empties the interpreter's free lists, so whether an
+            # object is allocated or reused does not depend on earlier runs.
+            gc.collect()
+            tracemalloc.start()
+            for _ in range(PROFILE_READINGS):
+                reader = self.loop_once(reader, uart)
+        finally:
+            sys.settrace(None)
+            tracemalloc.stop()
+
+        return ops / PROFILE_READINGS, blocks, size
+
+    def run(self, corpus, detail, minutes):
+        """Runs the corpus for 'minutes' of simulated time and returns the metrics."""
+        ops, blocks, size = self.profile(corpus, detail)
+        secs_per_reading_compute = ops * SECS_PER_OP
+
+        uart = self.reset(corpus, detail)
+        reader = None
+        n = 0
+        err_w = 0.0
+        err_pct = 0.0
+        n_pct = 0
+        end = minutes * 60.0
+        while self.sim.t < end:
+            reader = self.loop_once(reader, uart)
+            self.sim.t += secs_per_reading_compute
+            ref = self.sim.reference()
+            n += 1
+            err = abs(self.last_power - abs(ref))
+            err_w += err
+            if abs(ref) >= 50.0:
+                err_pct += err / abs(ref) * 100.0
+                n_pct += 1
+
+        hours = self.sim.t / 3600.0
+        return {
+            'readings_per_sim_sec': n / self.sim.t,
+            'ops_per_reading': ops,
+            'alloc_blocks': blocks,
+            'alloc_bytes': size,
+            'err_pct': err_pct / n_pct if n_pct else 0.0,
+            'err_w': err_w / n,
+            'uplinks_per_hour': len(uart.uplinks) / hours,
+            'air_bytes_per_hour': sum(b + LORAWAN_OVERHEAD for b in uart.uplinks) / hours,
+            'dropped_per_hour': uart.dropped / hours,
+        }
+
+
+def make_corpora(calib_mult):
+    """Returns the list of corpora to run."""
+    def steady(t): return 600.0
+    def step(t): return 100.0 if int(t // 300) % 2 == 0 else 1500.0
+    def ramp(t): return 2000.0 * (t % 1800.0) / 1800.0
+
+    # At 10 minutes, a multi-setting downlink changes the Detail thresholds to
+    # 5% and 20 W, the Detail max reading gap to 60 seconds and the Average 
+    # interval to 300 seconds.  The shorter gap forces a Detail send soon after the
+    # downlink, which the acknowledgement must not collide with.
+    reconfigure = [(600.0, b'04' + b'04020032' + b'050200C8' + b'0602003C' + b'0302012C')]
+
+    return [
+        SineCorpus('steady', steady, calib_mult),
+        SineCorpus('step', step, calib_mult),
+        SineCorpus('ramp', ramp, calib_mult),
+        SineCorpus('noisy', lambda t: 800.0, calib_mult, noisy=True),
+        SineCorpus('reversed_ct', steady, calib_mult, ct_sign=-1),
+        SineCorpus('no_zero_crossings', steady, calib_mult, v_offset=0.6, v_scale=0.5),
+        SineCorpus('reconfigure', step, calib_mult, downlinks=reconfigure),
+        RecordedCorpus(RECORDED_PATH, calib_mult),
+    ]
+
+
+def run_all(minutes):
+    """Runs every corpus with both readers and returns a dictionary of results
+    keyed by '<corpus>/<detail|average>'."""
+    fw = Firmware()
+    corpora = make_corpora(fw.calib_mult)
+    # Profile both readers once before any measurement, so the memory Python
+    # allocates the first time it traces each function is not counted against
+    # whichever run happens to come first.
+    with contextlib.redirect_stdout(io.StringIO()):
+        for detail in (True, False):
+            fw.profile(corpora[0], detail)
+
+    results = {}
+    for corpus in corpora:
+        for detail in (True, False):
+            key = '%s/%s' % (corpus.name, 'detail' if detail else 'average')
+            # the firmware prints each reading; keep the report readable.
+            with contextlib.redirect_stdout(io.StringIO()):
+                results[key] = fw.run(corpus, detail, minutes)
+            print(key, ' '.join('%s=%.4g' % kv for kv in results[key].items()), flush=True)
+    return results
+
+
+def compare(results, baseline, threshold):
+    """Returns a list of messages describing metrics that regressed beyond 'threshold'
+    relative to the 'baseline' results."""
+    regressions = []
+    for key, base_metrics in baseline.items():
+        if key not in results:
+            regressions.append(f'{key}: missing from results')
+            continue
+        for name, base in base_metrics.items():
+            higher_better, slack = METRICS[name]
+            val = results[key][name]
+            allowed = abs(base) * threshold + slack
+            worse = base - val if higher_better else val - base
+            if worse > allowed:
+                regressions.append(f'{key} {name}: {val:.4g} vs. baseline {base:.4g}')
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the firmware against simulated hardware.')
+    parser.add_argument('--minutes', type=float, default=30.0, help='Simulated minutes per run.')
+    parser.add_argument('--baseline', type=Path, default=BASELINE_PATH)
+    parser.add_argument('--threshold', type=float, default=THRESHOLD,
+                        help='Fractional regression allowed for each metric.')
+    parser.add_argument('--update', action='store_true', help='Write the results as the new baseline.')
+    args = parser.parse_args()
+
+    python = platform.python_version()
+    if not args.update:
+        baseline = json.loads(args.baseline.read_text())
+        if baseline['minutes'] != args.minutes:
+            sys.exit(f"Baseline was made with --minutes {baseline['minutes']}; use the same value.")
+        if baseline['python'].rsplit('.', 1)[0] != python.rsplit('.', 1)[0]:
+            sys.exit(f"Baseline was made with Python {baseline['python']}, not {python}. Run with "
+                     "that Python version, or record a new baseline with --update.")
+
+    results = run_all(args.minutes)
+
+    if args.update:
+        with open(args.baseline, 'w') as f:
+            json.dump({'python': python, 'minutes': args.minutes, 'results': results}, f, indent=2)
+            f.write('\n')
+        print(f'Baseline written to {args.baseline}')
+        return
+
+    regressions = compare(results, baseline['results'], args.threshold)
+    if regressions:
+        print('\nREGRESSIONS:')
+        for msg in regressions:
+            print('  ' + msg)
+        sys.exit(1)
+    print('\nNo regressions.')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,28 @@
+"""Makes the firmware in the lib directory importable on a PC.  The
+microcontroller module is replaced by a stand-in holding the non-volatile memory.
+"""
+import sys
+import types
+from pathlib import Path
+
+import pytest
+
+PROJECT_DIR = Path(__file__).resolve().parent.parent
+
+nvm = bytearray(b'\xff' * 256)
+sys.modules.setdefault('microcontroller', types.SimpleNamespace(nvm=nvm))
+sys.path.insert(0, str(PROJECT_DIR / 'lib'))
+sys.path.insert(0, str(PROJECT_DIR / 'tools'))
+
+
+@pytest.fixture
+def nvm_mem():
+    """Erased non-volatile memory and a configuration freshly loaded from it."""
+    import config
+    import lora
+    mem = sys.modules['microcontroller'].nvm
+    mem[:] = b'\xff' * len(mem)
+    config.config.__init__()
+    lora._ack_pending = None
+    lora._send_start = None
+    return mem
@@ -0,0 +1,108 @@
+"""Tests of tools/deploy.py using temporary directories as boards and a stand-in
+for the mpy-cross compiler.
+"""
+import stat
+import sys
+
+import pytest
+
+import deploy
+
+
+@pytest.fixture
+def project(tmp_path):
+    """A minimal project directory and a stand-in compiler that copies its input
+    to the output file and logs each compile."""
+    proj = tmp_path / 'project'
+    (proj / 'lib').mkdir(parents=True)
+    (proj / 'lib' / 'a.py').write_text('A = 1\n')
+    (proj / 'lib' / 'b.py').write_text('B = 2\n')
+    (proj / 'code.py').write_text('import a\n')
+    (proj / 'calibrate_default.py').write_text('CALIB_MULT = 1\n')
+
+    log = tmp_path / 'compiles.log'
+    compiler = tmp_path / 'mpy-cross-test'
+    compiler.write_text(
+        f'#!{sys.executable}\n'
+        'import shutil, sys\n'
+        f'open({str(log)!r}, "a").write(sys.argv[3] + "\\n")\n'
+        'shutil.copy(sys.argv[3], sys.argv[2])\n'
+    )
+    compiler.chmod(compiler.stat().st_mode | stat.S_IXUSR)
+
+    boards = [tmp_path / 'board1', tmp_path / 'board2']
+    for b in boards:
+        b.mkdir()
+
+    def run(only=None):
+        return deploy.deploy(only or boards, proj, tmp_path / 'cache', compiler, settle_secs=0)
+
+    def compiles():
+        return log.read_text().split() if log.exists() else []
+
+    return proj, boards, run, compiles
+
+
+def test_deploy_all_boards(project):
+    proj, boards, run, compiles = project
+    results = run()
+    for b in boards:
+        assert not isinstance(results[b], Exception)
+        assert (b / 'code.py').read_text() == 'import a\n'
+        assert (b / 'calibrate.py').read_text() == 'CALIB_MULT = 1\n'
+        assert (b / 'lib' / 'a.mpy').read_text() == 'A = 1\n'
+        assert (b / 'lib' / 'b.mpy').read_text() == 'B = 2\n'
+    assert len(compiles()) == 2      # compiled once, shared by the boards
+
+
+def test_calibrate_kept(project):
+    proj, boards, run, compiles = project
+    (boards[0] / 'calibrate.py').write_text('CALIB_MULT = 24000\n')
+    run()
+    assert (boards[0] / 'calibrate.py').read_text() == 'CALIB_MULT = 24000\n'
+
+
+def test_code_removed_first_and_written_last(project, monkeypatch):
+    proj, boards, run, compiles = project
+    run()
+    (proj / 'lib' / 'a.py').write_text('A = 3\n')
+
+    events = []
+    copy = deploy.copy_verified
+
+    def recording_copy(src, dest):
+        # the file being copied and whether code.py is on the board at the time
+        events.append((dest.relative_to(boards[0]).as_posix(), (boards[0] / 'code.py').exists()))
+        copy(src, dest)
+
+    monkeypatch.setattr(deploy, 'copy_verified', recording_copy)
+    run(boards[:1])
+    assert events == [('lib/a.mpy', False), ('code.py', False)]
+
+
+def test_unchanged_not_copied_and_cache_hit(project):
+    proj, boards, run, compiles = project
+    run()
+    results = run()
+    assert results == {b: [] for b in boards}
+    assert len(compiles()) == 2
+
+    # a changed source is recompiled and only it and code.py are copied
+    (proj / 'lib' / 'b.py').write_text('B = 4\n')
+    results = run()
+    for b in boards:
+        assert [p.name for p in results[b]] == ['b.mpy', 'code.py']
+    assert len(compiles()) == 3
+
+    # reverting the change is a cache hit
+    (proj / 'lib' / 'b.py').write_text('B = 2\n')
+    run()
+    assert len(compiles()) == 3
+
+
+def test_checksum_mismatch_reported(project, monkeypatch):
+    proj, boards, run, compiles = project
+    # a copy that loses its last byte
+    monkeypatch.setattr(deploy.shutil, 'copyfileobj', lambda fin, fout: fout.write(fin.read()[:-1]))
+    with pytest.raises(IOError):
+        deploy.copy_verified(proj / 'code.py', boards[0] / 'code.py')
@@ -0,0 +1,119 @@
+"""Tests of the downlink parsing in lora.py and Configuration.update in config.py.
+"""
+import pytest
+
+import lora
+from config import config, Configuration, NVM_SIZE
+
+
+class FakeUart:
+
+    def __init__(self):
+        self.writes = []
+
+    def write(self, cmd):
+        self.writes.append(bytes(cmd))
+
+
+def downlink(hex_str):
+    return b'+MSGHEX: PORT: 1; RX: "' + hex_str + b'"\r\n'
+
+
+@pytest.mark.parametrize('lin', [
+    b'+MSGHEX: Start\r\n',
+    downlink(b'040'),              # odd number of Hex characters
+    downlink(b'04zz'),             # not Hex
+    b'+MSGHEX: PORT: 1; RX: "0401',  # no closing quote
+    downlink(b'00' * (lora.MAX_DOWNLINK_BYTES + 1)),
+])
+def test_decode_rejects_bad_lines(lin):
+    assert lora._decode_downlink(lin) == 0
+
+
+def test_decode_upper_and_lower_case():
+    n = lora._decode_downlink(downlink(b'04aBcD'))
+    assert bytes(lora._rx_buf[:n]) == b'\x04\xab\xcd'
+
+
+def test_settings_applied(nvm_mem):
+    uart = FakeUart()
+    lora.check_for_downlink(downlink(b'04' b'010102' b'020101' b'04020014' b'07020168' b'06020384'), uart)
+    assert uart.writes == [b'AT+DR=2\n']
+    assert config.detail
+    assert config.pct_chg_thresh == 0.02
+    assert config.samples == 360
+    assert config.max_reading_gap_secs == 900
+    assert lora._ack_pending == lora.ACK_APPLIED
+    # the settings survive a reboot
+    assert bytes(nvm_mem[:NVM_SIZE]) == bytes(config.nvm_image())
+    hash_before = config.config_hash()
+    Configuration.__init__(config)
+    assert config.config_hash() == hash_before
+
+
+@pytest.mark.parametrize('payload', [
+    b'04' b'0402',                     # truncated tag/length
+    b'04' b'040200',                   # value shorter than length
+    b'04' b'040100',                   # wrong length for the tag
+    b'04' b'07020010',                 # samples below one AC cycle
+    b'04' b'07020400',                 # samples above the default
+    b'04' b'06020001',                 # max reading gap below the minimum gap
+    b'04' b'06020006',
+    b'04' b'03020001',                 # secs between transmits shorter than a send
+    b'04' b'03020003',
+    b'04' b'030200000',                # odd Hex length
+    b'04' b'01010A',                   # bad data rate
+    b'04' b'990100',                   # unknown tag
+])
+def test_settings_rejected(nvm_mem, payload):
+    uart = FakeUart()
+    hash_before = config.config_hash()
+    lora.check_for_downlink(downlink(payload), uart)
+    assert uart.writes == []
+    assert config.config_hash() == hash_before
+    assert bytes(nvm_mem[:NVM_SIZE]) == b'\xff' * NVM_SIZE
+
+
+def test_settings_all_or_nothing(nvm_mem):
+    # valid percent threshold followed by an out-of-range samples value
+    lora.check_for_downlink(downlink(b'04' b'04020032' b'07020010'), FakeUart())
+    assert config.pct_chg_thresh == Configuration.PCT_CHG_THRESH
+    assert lora._ack_pending == lora.ACK_REJECTED
+    assert bytes(nvm_mem[:NVM_SIZE]) == b'\xff' * NVM_SIZE
+
+
+def test_update_validation(nvm_mem):
+    assert not config.update({'secs_between_xmit': 0})
+    assert not config.update({'max_reading_gap_secs': 6})
+    assert config.update({'max_reading_gap_secs': 7, 'secs_between_xmit': 4})
+    assert not config.update({'detail': 2})
+    assert not config.update({'no_such_setting': 1})
+    assert config.update({'secs_between_xmit': 300, 'abs_chg_thresh': 0})
+    assert config.secs_between_xmit == 300
+    assert config.abs_chg_thresh == 0.0
+
+
+def test_legacy_requests_validated(nvm_mem):
+    lora.check_for_downlink(downlink(b'030000'), FakeUart())
+    assert config.secs_between_xmit == Configuration.SECS_BETWEEN_XMIT_DEFAULT
+    lora.check_for_downlink(downlink(b'030002'), FakeUart())
+    assert config.secs_between_xmit == Configuration.SECS_BETWEEN_XMIT_DEFAULT
+    lora.check_for_downlink(downlink(b'03012C'), FakeUart())
+    assert config.secs_between_xmit == 300
+    lora.check_for_downlink(downlink(b'0205'), FakeUart())
+    assert config.detail == Configuration.DETAIL_DEFAULT
+    lora.check_for_downlink(downlink(b'0201'), FakeUart())
+    assert config.detail
+
+
+def test_ack_waits_for_idle_e5(nvm_mem):
+    uart = FakeUart()
+    lora.send_msg('01', uart)
+    lora.check_for_downlink(downlink(b'04' b'04020032'), uart)
+    lora.send_pending_ack(uart)
+    assert len(uart.writes) == 1           # E5 busy, ack still pending
+    assert lora._ack_pending == lora.ACK_APPLIED
+    lora.check_for_downlink(b'+MSGHEX: Done\r\n', uart)
+    lora.send_pending_ack(uart)
+    assert uart.writes[-1] == b'AT+MSGHEX="0400%04X"\n' % config.config_hash()
+    assert lora._ack_pending is None
@@ -0,0 +1,182 @@
+#!/usr/bin/env python3
+"""Deploys the code to all mounted CircuitPython boards (CIRCUITPY volumes).
+
+The lib/*.py files are compiled to .mpy files with the mpy-cross compiler, and
+the compiled files are cached by a hash of their source so that unchanged files
+are not recompiled.  Only files that differ from what is already on a board are
+copied, and each copy is read back and compared by checksum (see copy_verified()
+for the limits of that check).  Boards are deployed to in parallel.
+
+Ordering on each board is the same as the original bash deploy script:
+    * the default calibrate file is copied only if the board has none,
+    * code.py is removed before any other file is copied,
+    * code.py is written last so all other files are in place when it starts.
+
+Usage, from the base project directory:
+    tools/deploy.py                     # deploy to all mounted CIRCUITPY volumes
+    tools/deploy.py --board /some/path  # deploy to specific board(s)
+"""
+import argparse
+import hashlib
+import os
+import shutil
+import subprocess
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+PROJECT_DIR = Path(__file__).resolve().parent.parent
+
+# CircuitPython mpy cross compiler, must match the CircuitPython version on the boards.
+# Download from: https://adafruit-circuit-python.s3.amazonaws.com/index.html?prefix=bin/mpy-cross/
+MPY_CROSS = PROJECT_DIR / 'mpy-cross-7.3.3'
+
+# Compiled .mpy files are cached here, named by a hash of their source.
+CACHE_DIR = PROJECT_DIR / '.mpy-cache'
+
+# Found that it was more reliable to wait a bit after deleting code.py before
+# copying the other files.
+SETTLE_SECS = 1.0
+
+def file_hash(path):
+    """Returns the SHA-256 Hex digest of the contents of the file at 'path'."""
+    return hashlib.sha256(Path(path).read_bytes()).hexdigest()
+
+def find_boards():
+    """Returns a list of the mounted CIRCUITPY volumes."""
+    if sys.platform.startswith('lin'):
+        candidates = list(Path('/media').glob('*/CIRCUITPY*')) + \
+            list(Path('/run/media').glob('*/CIRCUITPY*'))
+    elif sys.platform.startswith('dar'):
+        candidates = list(Path('/Volumes').glob('CIRCUITPY*'))
+    elif sys.platform.startswith('win'):
+        # CircuitPython writes boot_out.txt to the root of the drive.
+        candidates = [Path(f'{drive}:\\') for drive in 'DEFGHIJKLMNOPQRSTUVWXYZ']
+    else:
+        candidates = []
+    return sorted(p for p in candidates if (p / 'boot_out.txt').exists())
+
+def compile_libs(lib_dir, cache_dir=CACHE_DIR, mpy_cross=MPY_CROSS):
+    """Compiles each .py file in 'lib_dir' to a .mpy file, reusing a cached copy if
+    the source has not changed.  Returns a dictionary mapping .mpy file name to the
+    path of the compiled file in the cache.
+    """
+    cache_dir = Path(cache_dir)
+    cache_dir.mkdir(parents=True, exist_ok=True)
+    compiled = {}
+    for src in sorted(Path(lib_dir).glob('*.py')):
+        # include the compiler name in the hash so a new compiler version
+        # invalidates the cache.
+        h = hashlib.sha256(Path(mpy_cross).name.encode() + src.read_bytes()).hexdigest()
+        cached = cache_dir / f'{src.stem}-{h[:16]}.mpy'
+        if not cached.exists():
+            tmp = cached.with_suffix('.tmp')
+            subprocess.run([str(mpy_cross), '-o', str(tmp), str(src)], check=True)
+            tmp.replace(cached)
+        compiled[src.stem + '.mpy'] = cached
+    return compiled
+
+def copy_verified(src, dest):
+    """Copies 'src' to 'dest', flushing it to the device, and checks that the
+    copy read back has the same checksum as the source.  Raises IOError if it does not.
+
+    This is not proof of what the board has stored in its flash.  Where the OS supports
+    it (Linux), the file's pages are evicted from the host page cache before reading
+    back, so the read normally comes from the volume.  Elsewhere the read back is
+    usually served from the page cache, and only catches errors in the host side of
+    the copy.
+    """
+    with open(src, 'rb') as fin, open(dest, 'wb') as fout:
+        shutil.copyfileobj(fin, fout)
+        fout.flush()
+        os.fsync(fout.fileno())
+        if hasattr(os, 'posix_fadvise'):
+            os.posix_fadvise(fout.fileno(), 0, 0, os.POSIX_FADV_DONTNEED)
+    if file_hash(dest) != file_hash(src):
+        raise IOError(f'Checksum mismatch after copying {src} to {dest}')
+
+def needs_copy(src, dest):
+    """True if 'dest' does not exist or differs from 'src'."""
+    return not dest.exists() or file_hash(dest) != file_hash(src)
+
+def deploy_board(board, mpy_files, code_file, calibrate_file, settle_secs=SETTLE_SECS):
+    """Deploys to the CircuitPython volume at 'board'.  'mpy_files' maps .mpy file
+    name to the compiled file to copy into the board's lib directory.  Returns the
+    list of files that were copied.
+    """
+    board = Path(board)
+    lib_dir = board / 'lib'
+    board_code = board / 'code.py'
+    copied = []
+
+    # copy the default calibrate file if it does not exist on the board
+    board_calibrate = board / 'calibrate.py'
+    if not board_calibrate.exists():
+        copy_verified(calibrate_file, board_calibrate)
+        copied.append(board_calibrate)
+
+    lib_changes = [name for name, src in mpy_files.items() if needs_copy(src, lib_dir / name)]
+    if not lib_changes and not needs_copy(code_file, board_code):
+        return copied
+
+    # delete the code.py file first before copying anything else
+    if board_code.exists():
+        board_code.unlink()
+    time.sleep(settle_secs)
+
+    lib_dir.mkdir(exist_ok=True)
+    for name in lib_changes:
+        copy_verified(mpy_files[name], lib_dir / name)
+        copied.append(lib_dir / name)
+
+    # copy the code.py file last so that all other files are in place before starting the
+    # main script (code.py)
+    copy_verified(code_file, board_code)
+    copied.append(board_code)
+
+    return copied
+
+def deploy(boards, project_dir=PROJECT_DIR, cache_dir=CACHE_DIR, mpy_cross=MPY_CROSS,
+           settle_secs=SETTLE_SECS):
+    """Compiles the library and deploys to all of the 'boards' in parallel.
+    Returns a dictionary mapping board path to the list of files copied, or the
+    exception raised while deploying to that board.
+    """
+    project_dir = Path(project_dir)
+    mpy_files = compile_libs(project_dir / 'lib', cache_dir, mpy_cross)
+
+    def deploy_one(board):
+        try:
+            return deploy_board(board, mpy_files, project_dir / 'code.py',
+                                project_dir / 'calibrate_default.py', settle_secs)
+        except Exception as e:
+            return e
+
+    with ThreadPoolExecutor(max_workers=max(len(boards), 1)) as executor:
+        results = executor.map(deploy_one, boards)
+        return dict(zip(boards, results))
+
+def main():
+    parser = argparse.ArgumentParser(description='Deploy code to CircuitPython boards.')
+    parser.add_argument('--board', action='append', type=Path,
+                        help='Path to a board volume; may be repeated. Default is all CIRCUITPY volumes.')
+    args = parser.parse_args()
+
+    boards = args.board or find_boards()
+    if not boards:
+        print('No CIRCUITPY volumes found.')
+        sys.exit(1)
+
+    results = deploy(boards)
+    failed = False
+    for board, result in results.items():
+        if isinstance(result, Exception):
+            failed = True
+            print(f'{board}: FAILED, {result}')
+        else:
+            print(f'{board}: {len(result)} file(s) copied')
+    sys.exit(1 if failed else 0)
+
+if __name__ == '__main__':
+    main()